@@ -1,32 +1,69 @@
 """Main entry point for reviewly."""
-from rich import print
-from reviewly.config import get_config
-from reviewly.github_client import GitHubClient
-from reviewly.analyzer import DeepseekAnalyzer
+import argparse
+import asyncio
+from pathlib import Path
 
-def main():
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+def parse_args() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Generate a PR review checklist from past PR reviews.")
+    parser.add_argument("--no-cache", action="store_true", help="ignore cached reviews and LLM responses")
+    parser.add_argument("--refresh", action="store_true", help="revalidate cached reviews against GitHub using ETags")
+    return parser.parse_args()
+
+async def main(args: argparse.Namespace):
     """Main function."""
+    # Imported only after parse_args(), so --help doesn't load pydantic,
+    # dotenv, httpx or msgspec
+    from rich import print
+    from reviewly.cache import ResponseCache
+    from reviewly.config import get_config
+    from reviewly.github_client import GitHubClient
+    from reviewly.analyzer import DeepseekAnalyzer
+    
     # Load configuration
     config = get_config()
     
     # Initialize clients
-    github_client = GitHubClient(config.github_token, config.github_repo_url, cache_dir="./cache")
-    analyzer = DeepseekAnalyzer(config.deepseek_api_key)
+    response_cache = None if args.no_cache else ResponseCache(Path("./cache") / "responses.sqlite")
+    analyzer = None
+    github_client = None
     
     try:
-        # Fetch PR reviews
-        print("[bold blue]Fetching PR reviews...[/bold blue]")
-        reviews = github_client.get_pr_reviews(limit=50)  # Get last 50 PRs
+        analyzer = DeepseekAnalyzer(
+            config.deepseek_api_key,
+            use_batch_api=config.use_batch_api,
+            cache=response_cache,
+            batch_api_base_url=config.batch_api_base_url,
+            batch_api_model=config.batch_api_model,
+            batch_api_key=config.batch_api_key
+        )
         
-        if not reviews:
-            print("[bold yellow]No PR reviews found.[/bold yellow]")
-            return
+        # Authenticate with GitHub while the analyzer loads its tokenizer. Wait
+        # for both, so a client created before the other one fails still gets closed
+        github_result, warm_up_result = await asyncio.gather(
+            asyncio.to_thread(GitHubClient, config.github_token, config.github_repo_url, cache_dir="./cache"),
+            analyzer.warm_up(),
+            return_exceptions=True
+        )
+        if isinstance(github_result, GitHubClient):
+            github_client = github_result
+        for result in (github_result, warm_up_result):
+            if isinstance(result, BaseException):
+                raise result
         
-        print(f"[green]Found {len(reviews)} review comments[/green]")
+        # Stream PR reviews into the analyzer so batches are summarized while fetching
+        print("[bold blue]Fetching and analyzing PR reviews with DeepSeek...[/bold blue]")
+        reviews = github_client.iter_pr_reviews(limit=50, use_cache=not args.no_cache, refresh=args.refresh)  # Get last 50 PRs
+        checklist = await analyzer.analyze_reviews(reviews)
         
-        # Analyze reviews
-        print("[bold blue]Analyzing reviews with DeepSeek...[/bold blue]")
-        checklist = analyzer.analyze_reviews(reviews)
+        if checklist is None:
+            print("[bold yellow]No PR reviews found.[/bold yellow]")
+            return
         
         # Save results
         output_file = "pr_checklist.md"
@@ -39,6 +76,15 @@ def main():
         
     except Exception as e:
         print(f"[bold red]Error: {str(e)}[/bold red]")
+    finally:
+        if github_client:
+            await github_client.aclose()
+        if analyzer:
+            await analyzer.aclose()
+        if response_cache:
+            response_cache.close()
 
 if __name__ == "__main__":
-    main()
+    # Run everything on a single event loop, backed by uvloop when installed
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+        runner.run(main(parse_args()))
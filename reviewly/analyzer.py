@@ -1,30 +1,34 @@
 """LLM integration for analyzing PR reviews."""
-from typing import List
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import re
+from collections import defaultdict
+from functools import cached_property, lru_cache
+from typing import TYPE_CHECKING, AsyncIterable, AsyncIterator, List, Optional
+import httpx
 from .github_client import ReviewData
 
-class DeepseekAnalyzer:
-    """Client for analyzing PR reviews using Deepseek API."""
-    
-    def __init__(self, api_key: str):
-        self.llm = ChatOpenAI(
-            model="deepseek-reasoner",
-            openai_api_key=api_key,
-            base_url="https://api.deepseek.com/v1",
-            temperature=0.3,
-            top_p=0.1,
-            reasoning_effort="high"
-        )
-        self.summarization_prompt = self._create_summarization_prompt()
-        self.final_prompt = self._create_final_prompt()
-    
-    def _create_summarization_prompt(self) -> ChatPromptTemplate:
-        """Create the prompt template for summarizing a batch of reviews."""
-        template = """Analyze these PR review comments and extract key issues, patterns, and suggestions:
+# LangChain, OpenAI and tiktoken are heavy to import; load them only when used
+if TYPE_CHECKING:
+    import tiktoken
+    from langchain.prompts import ChatPromptTemplate
+    from .cache import ResponseCache
 
-{context}
+# Batch jobs finishing in one of these states will not make further progress
+_BATCH_FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+_CODE_FENCE_RE = re.compile(r"```\w*")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def _canonicalize_comment(comment: str) -> str:
+    """Normalize a review comment so trivially different copies compare equal."""
+    return _WHITESPACE_RE.sub(" ", _CODE_FENCE_RE.sub("", comment.lower())).strip()
+
+# Static instructions come first so every batch call shares a cacheable prefix
+_SUMMARIZATION_INSTRUCTIONS = """Analyze the PR review comments provided by the user and extract key issues, patterns, and suggestions.
 
 Provide a concise summary highlighting:
 1. Common issues found
@@ -33,14 +37,7 @@ Provide a concise summary highlighting:
 
 Keep the summary focused and actionable."""
 
-        return ChatPromptTemplate.from_template(template)
-    
-    def _create_final_prompt(self) -> ChatPromptTemplate:
-        """Create the prompt template for generating the final checklist."""
-        template = """You are an expert code reviewer. Based on these summaries of PR reviews, generate a comprehensive checklist for future code reviews.
-
-Review Summaries:
-{context}
+_FINAL_INSTRUCTIONS = """You are an expert code reviewer. Based on the summaries of PR reviews provided by the user, generate a comprehensive checklist for future code reviews.
 
 Create a detailed markdown checklist with the following sections:
 # PR Review Checklist
@@ -59,77 +56,377 @@ Create a detailed markdown checklist with the following sections:
 
 Make each item specific, actionable, and based on the actual review data. Use clear examples where helpful."""
 
-        return ChatPromptTemplate.from_template(template)
+@lru_cache(maxsize=None)
+def _get_prompts() -> tuple[ChatPromptTemplate, ChatPromptTemplate]:
+    """Build the summarization and final checklist prompt templates once per process."""
+    from langchain.prompts import ChatPromptTemplate
+
+    summarization_prompt = ChatPromptTemplate.from_messages([
+        ("system", _SUMMARIZATION_INSTRUCTIONS),
+        ("human", "{context}")
+    ])
+    final_prompt = ChatPromptTemplate.from_messages([
+        ("system", _FINAL_INSTRUCTIONS),
+        ("human", "Review Summaries:\n{context}")
+    ])
+    return summarization_prompt, final_prompt
+
+class DeepseekAnalyzer:
+    """Client for analyzing PR reviews using Deepseek API."""
     
-    def analyze_reviews(self, reviews: List[ReviewData]) -> str:
-        """Analyze PR reviews and generate a checklist."""
-        print(f"Processing {len(reviews)} reviews in batches...")
-        
-        # Group reviews by PR to maintain context
-        pr_groups = self._group_reviews_by_pr(reviews)
-        
-        # Split the groups into manageable chunks
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=10000,
-            chunk_overlap=1000,
-            separators=["\n\n", "\n", " "]
+    def __init__(
+        self,
+        api_key: str,
+        use_batch_api: bool = False,
+        cache: Optional[ResponseCache] = None,
+        batch_api_base_url: str = "",
+        batch_api_model: str = "",
+        batch_api_key: str = ""
+    ):
+        from langchain_openai import ChatOpenAI
+
+        # Deepseek has no Batch API, so batch jobs go to a separately configured provider
+        if use_batch_api and not (batch_api_base_url and batch_api_model and batch_api_key):
+            raise ValueError("The Batch API requires a base URL, model and API key for a provider that supports it")
+
+        self.use_batch_api = use_batch_api
+        self.cache = cache
+        self.batch_api_model = batch_api_model
+
+        # Pooled keep-alive HTTP/2 session shared by every LLM call
+        self._client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            timeout=httpx.Timeout(300.0, connect=10.0)
+        )
+
+        self.llm = ChatOpenAI(
+            model="deepseek-reasoner",
+            openai_api_key=api_key,
+            base_url="https://api.deepseek.com/v1",
+            temperature=0.3,
+            top_p=0.1,
+            reasoning_effort="high",
+            http_async_client=self._client
         )
+        self.summarization_prompt, self.final_prompt = _get_prompts()
+        self._summary_chain = self.summarization_prompt | self.llm
+        self._final_chain = self.final_prompt | self.llm
+
+        # Raw OpenAI-compatible client for the Batch API, sharing the same session
+        self._batch_client = None
+        if use_batch_api:
+            from openai import AsyncOpenAI
+
+            self._batch_client = AsyncOpenAI(
+                api_key=batch_api_key,
+                base_url=batch_api_base_url,
+                http_client=self._client
+            )
+    
+    @cached_property
+    def _encoding(self) -> Optional[tiktoken.Encoding]:
+        """Tokenizer used for batch budgeting, loaded on first use.
+
+        tiktoken downloads the encoding the first time it is used; if that
+        fails (e.g. offline), None is returned and token counts are estimated.
+        """
+        import tiktoken
+
+        # Deepseek has no published tiktoken encoding; o200k is close enough for budgeting
+        try:
+            return tiktoken.encoding_for_model("gpt-4o")
+        except Exception as e:
+            print(f"Warning: Could not load tokenizer, estimating token counts instead: {str(e)}")
+            return None
+    
+    async def warm_up(self):
+        """Load the tokenizer in a worker thread so it can overlap other startup work."""
+        await asyncio.to_thread(lambda: self._encoding)
+    
+    async def aclose(self):
+        """Close the underlying HTTP session."""
+        await self._client.aclose()
+
+    async def analyze_reviews(self, reviews: AsyncIterable[ReviewData]) -> Optional[str]:
+        """Analyze a stream of PR reviews and generate a checklist.
+
+        Batches are summarized while reviews are still arriving. Returns None
+        if the stream yields no reviews.
+        """
+        max_tokens = 8000  # Pack PRs into batches of up to ~8k context tokens
+        review_count = 0
         
-        # Process each batch and collect summaries
-        summaries = []
-        batch_size = 5  # Process 5 PRs at a time
+        async def contexts() -> AsyncIterator[str]:
+            nonlocal review_count
+            async for batch in self._iter_pr_batches(reviews, max_tokens):
+                review_count += sum(len(group) for group in batch)
+                yield self._prepare_context(batch)
         
-        for i in range(0, len(pr_groups), batch_size):
-            batch = pr_groups[i:i + batch_size]
-            context = self._prepare_context(batch)
-            
-            try:
-                # Generate summary for this batch
-                print(f"Analyzing batch {i//batch_size + 1}/{(len(pr_groups) + batch_size - 1)//batch_size}...")
-                chain = self.summarization_prompt | self.llm
-                result = chain.invoke({"context": context})
-                summaries.append(result.content)
-            except Exception as e:
-                print(f"Warning: Error processing batch {i//batch_size + 1}: {str(e)}")
-                continue
+        if self.use_batch_api:
+            # The Batch API needs every request up front
+            results = await self._summarize_all([context async for context in contexts()])
+        else:
+            results = await self._summarize_stream(contexts())
+        
+        if not review_count:
+            return None
+        print(f"Processed {review_count} reviews in {len(results)} batches")
         
+        summaries = [summary for summary in results if summary is not None]
         if not summaries:
             raise RuntimeError("Failed to generate any summaries from the reviews")
         
         # Generate final checklist from summaries
+        context = "\n\n".join(summaries)
+        key = self._cache_key(self.final_prompt, context)
+        cached = self._get_cached(key)
+        if cached is not None:
+            return cached
+        
         try:
-            chain = self.final_prompt | self.llm
-            result = chain.invoke({"context": "\n\n".join(summaries)})
-            return result.content
+            result = await self._final_chain.ainvoke({"context": context})
         except Exception as e:
             raise RuntimeError(f"Failed to generate final checklist: {str(e)}") from e
+        
+        self._set_cached(key, result.content)
+        return result.content
+    
+    def _cache_key(self, prompt: ChatPromptTemplate, context: str, model: Optional[str] = None) -> str:
+        """Hash the model and fully rendered prompt into a response cache key."""
+        payload = f"{model or self.llm.model_name}\0{prompt.format(context=context)}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _get_cached(self, key: str) -> Optional[str]:
+        """Get a cached response, if caching is enabled."""
+        return self.cache.get(key) if self.cache else None
+    
+    def _set_cached(self, key: str, value: str):
+        """Store a response, if caching is enabled."""
+        if self.cache:
+            self.cache.set(key, value)
+    
+    async def _summarize(self, index: int, context: str) -> Optional[str]:
+        """Summarize one batch context, using the response cache; failures yield None."""
+        key = self._cache_key(self.summarization_prompt, context)
+        cached = self._get_cached(key)
+        if cached is not None:
+            return cached
+        
+        print(f"Analyzing batch {index + 1}...")
+        try:
+            result = await self._summary_chain.ainvoke({"context": context})
+        except Exception as e:
+            print(f"Warning: Error processing batch {index + 1}: {str(e)}")
+            return None
+        
+        self._set_cached(key, result.content)
+        return result.content
     
-    def _group_reviews_by_pr(self, reviews: List[ReviewData]) -> List[List[ReviewData]]:
-        """Group reviews by PR number."""
-        pr_dict = {}
-        for review in reviews:
-            if review.pr_number not in pr_dict:
-                pr_dict[review.pr_number] = []
-            pr_dict[review.pr_number].append(review)
-        return list(pr_dict.values())
+    async def _summarize_stream(self, contexts: AsyncIterable[str], workers: int = 8) -> List[Optional[str]]:
+        """Summarize batch contexts as they arrive, with a bounded queue for backpressure."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * workers)
+        results: List[Optional[str]] = []
+        
+        async def worker():
+            while (item := await queue.get()) is not None:
+                index, context = item
+                # A failed batch (e.g. a locked response cache) must not kill
+                # the worker, or the producer would block on a full queue
+                try:
+                    results[index] = await self._summarize(index, context)
+                except Exception as e:
+                    print(f"Warning: Error processing batch {index + 1}: {str(e)}")
+        
+        tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+        try:
+            async for context in contexts:
+                results.append(None)
+                await queue.put((len(results) - 1, context))
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return results
+    
+    async def _summarize_all(self, contexts: List[str]) -> List[Optional[str]]:
+        """Summarize a complete list of batch contexts, via the Batch API when large.
+
+        Batches the Batch API job does not return are summarized interactively.
+        """
+        keys = [self._cache_key(self.summarization_prompt, context) for context in contexts]
+        batch_keys = [self._cache_key(self.summarization_prompt, context, self.batch_api_model) for context in contexts]
+        results = [self._get_cached(key) or self._get_cached(batch_key) for key, batch_key in zip(keys, batch_keys)]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if len(pending) < len(contexts):
+            print(f"Reusing {len(contexts) - len(pending)} cached batch summaries")
+        
+        # Large non-interactive runs go through the discounted Batch API
+        if len(pending) > 8:
+            try:
+                fresh = await self._summarize_with_batch_api([contexts[i] for i in pending])
+            except Exception as e:
+                print(f"Warning: Batch API job failed, falling back to interactive calls: {str(e)}")
+            else:
+                for i, summary in zip(pending, fresh):
+                    if summary is not None:
+                        results[i] = summary
+                        self._set_cached(batch_keys[i], summary)
+                pending = [i for i in pending if results[i] is None]
+        
+        if pending:
+            sem = asyncio.Semaphore(8)
+            
+            async def summarize(index: int) -> Optional[str]:
+                async with sem:
+                    return await self._summarize(index, contexts[index])
+            
+            fresh = await asyncio.gather(*map(summarize, pending))
+            for i, summary in zip(pending, fresh):
+                results[i] = summary
+        return results
+    
+    async def _summarize_with_batch_api(self, contexts: List[str], poll_interval: float = 30.0) -> List[Optional[str]]:
+        """Summarize batch contexts as a single provider Batch API job; failed batches yield None."""
+        print(f"Submitting {len(contexts)} batches to the Batch API...")
+        
+        # One chat completion request per line
+        lines = []
+        for index, context in enumerate(contexts):
+            messages = self.summarization_prompt.format_messages(context=context)
+            lines.append(json.dumps({
+                "custom_id": f"batch-{index}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.batch_api_model,
+                    "messages": [
+                        {"role": {"human": "user", "ai": "assistant"}.get(m.type, m.type), "content": m.content}
+                        for m in messages
+                    ],
+                    "temperature": self.llm.temperature,
+                    "top_p": self.llm.top_p
+                }
+            }))
+        
+        batch_file = await self._batch_client.files.create(
+            file=("summaries.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await self._batch_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        
+        # Poll until the job settles
+        while batch.status not in _BATCH_FINAL_STATES:
+            await asyncio.sleep(poll_interval)
+            batch = await self._batch_client.batches.retrieve(batch.id)
+            print(f"Batch job {batch.id}: {batch.status}")
+        
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"Batch job {batch.id} did not complete (status: {batch.status})")
+        
+        output = await self._batch_client.files.content(batch.output_file_id)
+        results = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if item.get("error") or response.get("status_code") != 200:
+                print(f"Warning: Error processing {item.get('custom_id')}: {item.get('error') or response.get('body')}")
+                continue
+            results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        
+        # Keep the original batch order
+        return [results.get(f"batch-{i}") for i in range(len(contexts))]
+    
+    async def _iter_pr_groups(self, reviews: AsyncIterable[ReviewData]) -> AsyncIterator[List[ReviewData]]:
+        """Group a stream of reviews by PR.
+
+        Reviews of the same PR are expected to arrive consecutively.
+        """
+        group = []
+        async for review in reviews:
+            if group and review.pr_number != group[0].pr_number:
+                yield group
+                group = []
+            group.append(review)
+        
+        if group:
+            yield group
+    
+    async def _iter_pr_batches(self, reviews: AsyncIterable[ReviewData], max_tokens: int) -> AsyncIterator[List[List[ReviewData]]]:
+        """Greedily pack PR groups into batches whose context fits in max_tokens.
+
+        A single PR larger than the budget gets a batch of its own.
+        """
+        batch = []
+        batch_tokens = 0
+        async for group in self._iter_pr_groups(reviews):
+            tokens = self._count_tokens(self._prepare_context([group]))
+            if batch and batch_tokens + tokens > max_tokens:
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append(group)
+            batch_tokens += tokens
+        
+        if batch:
+            yield batch
+    
+    def _count_tokens(self, text: str) -> int:
+        """Estimate the number of tokens in a piece of text."""
+        if self._encoding is None:
+            # Roughly four characters per token, which is enough for batch budgeting
+            return len(text) // 4
+        return len(self._encoding.encode(text, disallowed_special=()))
     
     def _prepare_context(self, pr_groups: List[List[ReviewData]]) -> str:
-        """Prepare context from groups of review data for the LLM."""
+        """Prepare context from groups of review data for the LLM.
+
+        Repeated comments are sent once, annotated with how often and on which
+        PRs they occurred.
+        """
+        # Canonicalize every comment once and count occurrences across the batch
+        group_keys = [[_canonicalize_comment(review.review_comment) for review in group] for group in pr_groups]
+        occurrences = defaultdict(list)
+        for group, keys in zip(pr_groups, group_keys):
+            for review, key in zip(group, keys):
+                occurrences[key].append(review.pr_number)
+        
         context_parts = []
+        seen = set()
         
-        for group in pr_groups:
-            if not group:
+        for group, keys in zip(pr_groups, group_keys):
+            # Skip PRs whose comments all repeat earlier ones; the occurrence
+            # annotation already lists their PR number
+            if all(key in seen for key in keys):
                 continue
                 
             pr_num = group[0].pr_number
             context_parts.append(f"PR #{pr_num}:")
             
-            for review in group:
+            for review, key in zip(group, keys):
+                if key in seen:
+                    continue
+                seen.add(key)
+                
                 context_parts.append(f"File: {review.file_path}")
                 if review.code_chunk:
                     # Truncate very long code chunks
                     code = review.code_chunk[:500] + "..." if len(review.code_chunk) > 500 else review.code_chunk
                     context_parts.append(f"Code:\n```\n{code}\n```")
-                context_parts.append(f"Review comment: {review.review_comment}\n")
+                
+                prs = occurrences[key]
+                if len(prs) > 1:
+                    pr_list = ", ".join(f"#{n}" for n in dict.fromkeys(prs))
+                    context_parts.append(f"Review comment (seen {len(prs)} times across PRs {pr_list}): {review.review_comment}\n")
+                else:
+                    context_parts.append(f"Review comment: {review.review_comment}\n")
         
         return "\n".join(context_parts)
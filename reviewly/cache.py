@@ -0,0 +1,29 @@
+"""Local cache for LLM responses."""
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+class ResponseCache:
+    """SQLite-backed cache mapping request hashes to LLM responses."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the cached response for a key, if any."""
+        row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        """Store a response under a key."""
+        self._conn.execute("INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)", (key, value))
+        self._conn.commit()
+
+    def close(self):
+        """Close the database connection."""
+        self._conn.close()
@@ -9,6 +9,10 @@ class Config(BaseModel):
     github_token: str
     github_repo_url: str
     deepseek_api_key: str
+    use_batch_api: bool = False
+    batch_api_base_url: str = ""
+    batch_api_model: str = ""
+    batch_api_key: str = ""
 
 @lru_cache()
 def get_config() -> Config:
@@ -18,5 +22,9 @@ def get_config() -> Config:
     return Config(
         github_token=os.getenv("GITHUB_TOKEN", ""),
         github_repo_url=os.getenv("GITHUB_REPO_URL", ""),
-        deepseek_api_key=os.getenv("DEEPSEEK_API_KEY", "")
+        deepseek_api_key=os.getenv("DEEPSEEK_API_KEY", ""),
+        use_batch_api=os.getenv("USE_BATCH_API", "").lower() in ("1", "true", "yes"),
+        batch_api_base_url=os.getenv("BATCH_API_BASE_URL", ""),
+        batch_api_model=os.getenv("BATCH_API_MODEL", ""),
+        batch_api_key=os.getenv("BATCH_API_KEY", "")
     )
@@ -1,18 +1,23 @@
 """GitHub related functionality."""
+from __future__ import annotations
+
+import asyncio
+import re
 import sys
-import json
 import os
-from datetime import datetime
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional
-from urllib.parse import urlparse
-from pydantic import BaseModel
-from github import Github
-from github.PullRequest import PullRequest
-from github.Repository import Repository
-from github.GithubException import GithubException
-
-class ReviewData(BaseModel):
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Tuple
+import httpx
+import msgspec
+
+# PyGithub is heavy to import; load it only when a client is created
+if TYPE_CHECKING:
+    from github.Repository import Repository
+
+@dataclass(slots=True)
+class ReviewData:
     """Model for storing review data."""
     pr_number: int
     file_path: str
@@ -20,32 +25,112 @@ class ReviewData(BaseModel):
     review_comment: str
     line_number: Optional[int] = None
 
-    class Config:
-        """Pydantic config to allow json serialization"""
-        json_encoders = {
-            datetime: lambda v: v.isoformat()
+# owner/repo, optionally prefixed by https://host/, ssh://[user@]host/, a bare
+# host/ (e.g. github.com/) or git@host:, with an optional .git suffix and an
+# ignored query string or fragment (as in URLs copied from a browser)
+_REPO_RE = re.compile(
+    r"^(?:(?:https?|ssh)://(?:[^@/]+@)?[^/]+/|git@[^:]+:|[^/:@]+\.[^/:@]+/)?"
+    r"(?P<owner>[^/?#]+)/(?P<repo>[^/?#]+?)(?:\.git)?/?(?:[?#].*)?$"
+)
+
+# Cache files are decoded straight into ReviewData, without an intermediate dict tree
+_CACHE_ENCODER = msgspec.json.Encoder()
+_REVIEWS_DECODER = msgspec.json.Decoder(List[ReviewData])
+
+# PR number -> (ETag of its review comments, parsed reviews)
+_ETAGS_DECODER = msgspec.json.Decoder(Dict[int, Tuple[str, List[ReviewData]]])
+
+# Path prefix of GraphQL errors that belong to a single PR node
+_PR_NODES_PATH = ["repository", "pullRequests", "nodes"]
+
+# Closed and merged PRs with their review thread comments, newest first
+_PR_REVIEWS_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: $first, after: $after, states: [CLOSED, MERGED],
+                 orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        reviewThreads(first: 50) {
+          pageInfo { hasNextPage }
+          nodes {
+            comments(first: 50) {
+              pageInfo { hasNextPage }
+              nodes { path diffHunk body line }
+            }
+          }
         }
+      }
+    }
+  }
+}
+"""
+
+class _ReviewCacheWriter:
+    """Write reviews to a cache file one at a time, as a JSON array.
+
+    Reviews go to a temporary file that only replaces the cache once the
+    stream has been fully consumed, so an interrupted stream never leaves
+    a truncated cache behind.
+    """
+
+    def __init__(self, cache_path: Path):
+        self.cache_path = cache_path
+        self.count = 0
+        self._tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(b"[")
+
+    def add(self, review: ReviewData):
+        """Append a review to the cache file."""
+        if self.count:
+            self._file.write(b",")
+        self._file.write(_CACHE_ENCODER.encode(review))
+        self.count += 1
+
+    def commit(self):
+        """Finish the cache file and move it into place."""
+        self._file.write(b"]")
+        self._file.close()
+        self._tmp_path.replace(self.cache_path)
+
+    def discard(self):
+        """Drop the partially written cache file."""
+        self._file.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+@lru_cache(maxsize=4)
+def _get_authenticated_login(token: str) -> str:
+    """Get the login of the token's user, checked once per token per process."""
+    from github import Github
+
+    return Github(token).get_user().login
 
 class GitHubClient:
     """Client for interacting with GitHub API."""
     
     def __init__(self, token: str, repo_url: str, cache_dir: str = None):
+        from github import Github
+        from github.GithubException import GithubException
+
         self.cache_dir = cache_dir or os.path.join(os.path.dirname(__file__), '..', 'cache')
         os.makedirs(self.cache_dir, exist_ok=True)
         
         try:
             self.github = Github(token)
-            # Test authentication first            
-            try:
-                user = self.github.get_user().login
-                print(f"Successfully authenticated as: {user}")
-            except GithubException as e:
-                if e.status == 401:
-                    print("Error: Invalid GitHub token. Please check your token.", file=sys.stderr)
-                    raise e
-                else:
-                    print(f"GitHub API Error: {str(e)}", file=sys.stderr)
-                    raise e
+            # Test authentication first, unless explicitly skipped (e.g. for benchmarks)
+            if os.getenv("REVIEWLY_SKIP_AUTH_CHECK") != "1":
+                try:
+                    user = _get_authenticated_login(token)
+                    print(f"Successfully authenticated as: {user}")
+                except GithubException as e:
+                    if e.status == 401:
+                        print("Error: Invalid GitHub token. Please check your token.", file=sys.stderr)
+                        raise e
+                    else:
+                        print(f"GitHub API Error: {str(e)}", file=sys.stderr)
+                        raise e
             
             # Extract owner and repo from URL
             self.owner, self.repo_name = self._parse_repo_url(repo_url)
@@ -71,6 +156,18 @@ class GitHubClient:
                     print("2. You have access to this repository", file=sys.stderr)
                     raise e
                 raise e
+            
+            # Shared HTTP/2 session for GraphQL and conditional REST requests,
+            # created only once the checks above have passed so it can't leak
+            self._http = httpx.AsyncClient(
+                http2=True,
+                base_url="https://api.github.com",
+                headers={
+                    "Authorization": f"Bearer {token}",
+                    "Accept": "application/vnd.github+json"
+                },
+                timeout=30.0
+            )
                 
         except Exception as e:
             print(f"Error initializing GitHub client: {str(e)}", file=sys.stderr)
@@ -78,28 +175,11 @@ class GitHubClient:
 
     def _parse_repo_url(self, repo_url: str) -> tuple[str, str]:
         """Parse the repository URL to extract owner and repo name."""
-        # Handle case where URL is already in owner/repo format
-        if '/' in repo_url and not any(x in repo_url for x in ['http', 'git@']):
-            parts = repo_url.split('/')
-            return parts[-2], parts[-1]  # Preserve case
-        
-        # Handle full URLs
-        url = urlparse(repo_url)
-        if not url.path:
+        match = _REPO_RE.match(repo_url.strip())
+        if not match:
             raise ValueError(f"Invalid repository URL format: {repo_url}")
-        
-        # Remove .git extension if present and preserve case
-        path = url.path.rstrip('/')
-        if path.endswith('.git'):
-            path = path[:-4]
-        
-        # Split path into parts and get the last two components
-        parts = [p for p in path.split('/') if p]
-        if len(parts) < 2:
-            raise ValueError(f"Invalid repository URL format: {repo_url}")
-        
-        # Return owner and repo name with original case preserved
-        return parts[-2], parts[-1]  # Preserve case exactly as in URL
+        # Case is preserved exactly as in the URL
+        return match["owner"], match["repo"]
 
     @property
     def repo(self) -> Repository:
@@ -123,61 +203,251 @@ class GitHubClient:
         if cache_path.exists():
             print("Loading reviews from cache...")
             try:
-                with open(cache_path, 'r') as f:
-                    data = json.load(f)
-                    return [ReviewData(**item) for item in data]
+                return _REVIEWS_DECODER.decode(cache_path.read_bytes())
             except Exception as e:
                 print(f"Warning: Failed to load cache: {str(e)}", file=sys.stderr)
         return None
 
-    def _save_to_cache(self, reviews: List[ReviewData]):
-        """Save review data to cache."""
-        cache_path = self._get_cache_path()
-        print(f"Saving {len(reviews)} reviews to cache...")
+    def _open_cache_writer(self) -> Optional[_ReviewCacheWriter]:
+        """Start writing review data to cache, or None if it can't be written."""
         try:
-            with open(cache_path, 'w') as f:
-                json.dump([review.dict() for review in reviews], f, indent=2)
+            return _ReviewCacheWriter(self._get_cache_path())
         except Exception as e:
             print(f"Warning: Failed to save cache: {str(e)}", file=sys.stderr)
+            return None
+
+    def _get_etags_path(self) -> Path:
+        """Get the path to the ETag cache file for the current repo."""
+        return Path(self.cache_dir) / f"{self.owner}_{self.repo_name}_etags.json"
+
+    def _load_etags(self) -> Dict[int, Tuple[str, List[ReviewData]]]:
+        """Load per-PR ETags and reviews from cache if available."""
+        etags_path = self._get_etags_path()
+        if etags_path.exists():
+            try:
+                return _ETAGS_DECODER.decode(etags_path.read_bytes())
+            except Exception as e:
+                print(f"Warning: Failed to load ETag cache: {str(e)}", file=sys.stderr)
+        return {}
+
+    def _save_etags(self, etags: Dict[int, Tuple[str, List[ReviewData]]]):
+        """Save per-PR ETags and reviews to cache."""
+        try:
+            self._get_etags_path().write_bytes(_CACHE_ENCODER.encode(etags))
+        except Exception as e:
+            print(f"Warning: Failed to save ETag cache: {str(e)}", file=sys.stderr)
 
-    def get_pr_reviews(self, limit: int = 100, use_cache: bool = True) -> List[ReviewData]:
+    async def aclose(self):
+        """Close the underlying HTTP session."""
+        await self._http.aclose()
+
+    async def _graphql(self, query: str, variables: dict) -> Tuple[dict, List[dict]]:
+        """Run a GraphQL query against the GitHub API.
+
+        Returns the data along with any partial errors; raises only if no data
+        came back at all.
+        """
+        response = await self._http.post("/graphql", json={"query": query, "variables": variables})
+        response.raise_for_status()
+        payload = response.json()
+        errors = payload.get("errors") or []
+        if not payload.get("data"):
+            messages = "; ".join(error.get("message", str(error)) for error in errors)
+            raise RuntimeError(f"GitHub GraphQL error: {messages}")
+        return payload["data"], errors
+
+    async def get_pr_reviews(self, limit: int = 100, use_cache: bool = True, refresh: bool = False) -> List[ReviewData]:
         """Get review data from recent pull requests."""
-        if use_cache:
+        return [review async for review in self.iter_pr_reviews(limit, use_cache, refresh)]
+
+    async def iter_pr_reviews(self, limit: int = 100, use_cache: bool = True, refresh: bool = False) -> AsyncIterator[ReviewData]:
+        """Yield review data from recent pull requests as each page arrives.
+
+        Reviews of the same PR are yielded consecutively. Each review is
+        written to the cache as it is yielded rather than kept in memory, and
+        the cache is replaced once the stream has been fully consumed. With
+        refresh, cached reviews are revalidated per PR using ETags instead of
+        being returned as is.
+        """
+        if use_cache and not refresh:
             cached = self._load_from_cache()
             if cached:
-                return cached
+                for review in cached:
+                    yield review
+                return
 
-        reviews = []
-        print("Fetching PR reviews...")
-        # Get pull requests
-        pulls = self.repo.get_pulls(state='closed', sort='updated', direction='desc')
-        
-        for pr in pulls[:limit]:
-            print(f"Processing PR #{pr.number}...")
-            try:
-                # Get review comments for the PR
-                review_comments = pr.get_review_comments()
-                
-                for comment in review_comments:
-                    # Get line number safely, defaulting to None if not available
+        if refresh:
+            source = self._iter_refreshed_reviews(limit, use_cache)
+        else:
+            source = self._iter_fetched_reviews(limit)
+
+        writer = self._open_cache_writer()
+        count = 0
+        try:
+            async for review in source:
+                if writer:
                     try:
-                        line_number = comment.line if hasattr(comment, 'line') else None
-                    except AttributeError:
-                        line_number = None
-
-                    reviews.append(
-                        ReviewData(
-                            pr_number=pr.number,
-                            file_path=comment.path,
-                            code_chunk=comment.diff_hunk if hasattr(comment, 'diff_hunk') else '',
-                            review_comment=comment.body,
-                            line_number=line_number
-                        )
-                    )
+                        writer.add(review)
+                    except Exception as e:
+                        print(f"Warning: Failed to save cache: {str(e)}", file=sys.stderr)
+                        writer.discard()
+                        writer = None
+                count += 1
+                yield review
+        except BaseException:
+            if writer:
+                writer.discard()
+            raise
+
+        print(f"Found {count} review comments")
+        if writer:
+            print(f"Saving {count} reviews to cache...")
+            try:
+                writer.commit()
             except Exception as e:
-                print(f"Warning: Error processing PR #{pr.number}: {str(e)}", file=sys.stderr)
-                continue
-        
-        print(f"Found {len(reviews)} review comments")
-        self._save_to_cache(reviews)
-        return reviews
+                print(f"Warning: Failed to save cache: {str(e)}", file=sys.stderr)
+                writer.discard()
+
+    async def _iter_fetched_reviews(self, limit: int) -> AsyncIterator[ReviewData]:
+        """Yield review data fetched page by page with GraphQL."""
+        print("Fetching PR reviews...")
+        # Fetch PRs and their review comments in small pages, so the first
+        # reviews can be analyzed while later pages are still loading
+        cursor = None
+        remaining = limit
+        while remaining > 0:
+            data, errors = await self._graphql(_PR_REVIEWS_QUERY, {
+                "owner": self.owner,
+                "name": self.repo_name,
+                "first": min(remaining, 10),
+                "after": cursor
+            })
+            pull_requests = data["repository"]["pullRequests"]
+
+            # Errors scoped to a single PR node only skip that PR
+            pr_errors = {}
+            for error in errors:
+                path = error.get("path") or []
+                if path[:3] == _PR_NODES_PATH and len(path) > 3:
+                    pr_errors[path[3]] = error.get("message", str(error))
+                else:
+                    print(f"Warning: GitHub GraphQL error: {error.get('message', str(error))}", file=sys.stderr)
+
+            for index, pr in enumerate(pull_requests["nodes"]):
+                if pr is None or index in pr_errors:
+                    number = f"#{pr['number']}" if pr else f"at position {index + 1}"
+                    print(f"Warning: Error processing PR {number}: {pr_errors.get(index)}", file=sys.stderr)
+                    continue
+
+                print(f"Processing PR #{pr['number']}...")
+                threads = pr["reviewThreads"]
+                if threads["pageInfo"]["hasNextPage"]:
+                    print(f"Warning: PR #{pr['number']} has more than 50 review threads; only the first 50 were fetched", file=sys.stderr)
+                for thread in threads["nodes"]:
+                    if thread["comments"]["pageInfo"]["hasNextPage"]:
+                        print(f"Warning: A review thread on PR #{pr['number']} has more than 50 comments; only the first 50 were fetched", file=sys.stderr)
+                    for comment in thread["comments"]["nodes"]:
+                        review = ReviewData(
+                            pr_number=pr["number"],
+                            file_path=comment["path"],
+                            code_chunk=comment.get("diffHunk") or '',
+                            review_comment=comment["body"],
+                            line_number=comment.get("line")
+                        )
+                        yield review
+
+            remaining -= len(pull_requests["nodes"])
+            if not pull_requests["pageInfo"]["hasNextPage"]:
+                break
+            cursor = pull_requests["pageInfo"]["endCursor"]
+
+    async def _iter_refreshed_reviews(self, limit: int, use_cache: bool) -> AsyncIterator[ReviewData]:
+        """Yield review data, revalidating each PR's comments with a conditional request."""
+        etags = self._load_etags() if use_cache else {}
+        print("Refreshing PR reviews...")
+        numbers = await self._list_pr_numbers(limit)
+
+        # Revalidate all PRs concurrently, bounded by a semaphore
+        sem = asyncio.Semaphore(16)
+
+        async def fetch(number: int) -> Tuple[Optional[str], List[ReviewData]]:
+            async with sem:
+                try:
+                    return await self._fetch_pr_comments(number, etags.get(number))
+                except Exception as e:
+                    print(f"Warning: Error processing PR #{number}: {str(e)}", file=sys.stderr)
+                    return etags.get(number, (None, []))
+
+        tasks = [asyncio.create_task(fetch(number)) for number in numbers]
+        fresh_etags = {}
+        try:
+            for number, task in zip(numbers, tasks):
+                etag, pr_reviews = await task
+                if etag:
+                    fresh_etags[number] = (etag, pr_reviews)
+                for review in pr_reviews:
+                    yield review
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        self._save_etags(fresh_etags)
+
+    async def _list_pr_numbers(self, limit: int) -> List[int]:
+        """List the numbers of the most recently updated closed PRs."""
+        numbers = []
+        page = 1
+        while len(numbers) < limit:
+            response = await self._http.get(f"/repos/{self.owner}/{self.repo_name}/pulls", params={
+                "state": "closed",
+                "sort": "updated",
+                "direction": "desc",
+                "per_page": min(limit, 100),
+                "page": page
+            })
+            response.raise_for_status()
+            pulls = response.json()
+            numbers.extend(pr["number"] for pr in pulls)
+            if "next" not in response.links:
+                break
+            page += 1
+        return numbers[:limit]
+
+    async def _fetch_pr_comments(
+        self, number: int, cached: Optional[Tuple[str, List[ReviewData]]]
+    ) -> Tuple[Optional[str], List[ReviewData]]:
+        """Fetch the review comments of a PR, reusing cached ones if its ETag still matches.
+
+        Returns the ETag to store (None if the comments span several pages,
+        since the first page's ETag does not cover the rest) and the reviews.
+        """
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        response = await self._http.get(
+            f"/repos/{self.owner}/{self.repo_name}/pulls/{number}/comments",
+            params={"per_page": 100},
+            headers=headers
+        )
+        if response.status_code == 304:
+            print(f"PR #{number} unchanged")
+            return cached
+        response.raise_for_status()
+
+        print(f"Processing PR #{number}...")
+        etag = response.headers.get("ETag")
+        comments = response.json()
+        while "next" in response.links:
+            etag = None
+            response = await self._http.get(response.links["next"]["url"])
+            response.raise_for_status()
+            comments.extend(response.json())
+
+        return etag, [
+            ReviewData(
+                pr_number=number,
+                file_path=comment["path"],
+                code_chunk=comment.get("diff_hunk") or '',
+                review_comment=comment["body"],
+                line_number=comment.get("line")
+            )
+            for comment in comments
+        ]